@@ -1,3 +1,5 @@
+import os
+import numpy as np
 import pandas as pd
 import xgboost as xgb
 import logging
@@ -6,30 +8,89 @@ import logging
 
 logging.basicConfig(level=logging.INFO)
 
-# Required bought columns orchestrator passes
-REQUIRED_COLUMNS = [
+# Required bought columns orchestrator passes (deduplicated, order preserved)
+REQUIRED_COLUMNS = list(dict.fromkeys([
     "open", "high", "low", "close", "volume", "quote_asset_volume",
     "number_of_trades", "taker_buy_base", "taker_buy_quote", "macd",
     "macd_signal", "macd_histogram", "rsi", "rsi_sma", "ema_100",
     "ema_200", "atr", "relative_volume", "quote_volume_ratio",
     "buy_sell_pressure", "ema_ratio", "rsi_x_relative_volume",
     "macd_histogram_x_atr", "buy_sell_pressure_x_ema_ratio", "relative_volume", "rsi_x_relative_volume"
-]
+]))
+
+# Batches below this size predict single-threaded; thread start-up would dominate
+SMALL_BATCH_ROWS = 512
+
+# Loaded boosters keyed by (model_file, mtime) so repeated runs skip re-parsing the JSON
+_MODEL_CACHE = {}
+
+
+def _load_model(model_file):
+    """
+    Return the Booster and the feature columns it expects (in training order)
+    for model_file, loading from disk only when the file is new or has been
+    modified since the last load.
+    """
+    key = (model_file, os.path.getmtime(model_file))
+    cached = _MODEL_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    model = xgb.Booster()
+    model.load_model(model_file)
+    feature_cols = list(model.feature_names or REQUIRED_COLUMNS)
+
+    # Inputs are fed as float32, which only matches numerically-typed training features
+    non_float_types = {t for t in (model.feature_types or []) if t not in ("float", "int", "i", "q")}
+    if non_float_types:
+        logging.warning(f"Model {model_file} has non-numeric feature types {non_float_types}; float32 input may not match training")
+
+    # Drop stale entries for the same file before storing the fresh one
+    for stale_key in [k for k in _MODEL_CACHE if k[0] == model_file]:
+        del _MODEL_CACHE[stale_key]
+    _MODEL_CACHE[key] = (model, feature_cols)
+    logging.info(f"Loaded XGBoost model from {model_file}")
+    return model, feature_cols
+
+
+def get_feature_columns(model_file):
+    """
+    Feature columns model_file expects, in training order. Callers building a
+    'features' matrix for run() must lay its columns out in this order.
+    """
+    _, feature_cols = _load_model(model_file)
+    return feature_cols
+
+
+def _predict(model, arr):
+    """
+    Predict with the thread count chosen from the batch size: one thread for
+    small batches, all cores for larger ones.
+    """
+    nthread = 1 if len(arr) < SMALL_BATCH_ROWS else os.cpu_count()
+    model.set_param({"nthread": nthread})
+    return model.inplace_predict(arr)
+
 
 def run(inputs):
     """
     Stage 2 model prediction logic.
 
     inputs dict expects:
-        - 'data': DataFrame with latest features per coin
+        - 'data': DataFrame with latest features per coin, or
+        - 'features': 2-D ndarray already laid out as get_feature_columns(model_file)
         - 'model_file': path to trained XGBoost model JSON file
     """
 
     df = inputs.get("data")
+    features = inputs.get("features")
     model_file = inputs.get("model_file")
 
     # -------------------------- Input validation --------------------------
-    if df is None or df.empty:
+    if features is None and (df is None or df.empty):
+        logging.error("Input data is missing or empty")
+        return {"status": "error", "message": "No input data"}
+    if features is not None and len(features) == 0:
         logging.error("Input data is missing or empty")
         return {"status": "error", "message": "No input data"}
 
@@ -39,36 +100,47 @@ def run(inputs):
 
     # -------------------------- Load trained XGBoost model --------------------------
     try:
-        model = xgb.Booster()
-        model.load_model(model_file)
-        logging.info(f"Loaded XGBoost model from {model_file}")
+        model, feature_cols = _load_model(model_file)
     except Exception as e:
         logging.error(f"Error loading model: {e}")
         return {"status": "error", "message": "Failed to load model"}
 
-    # -------------------------- Ensure required columns --------------------------
-    feature_cols = [c for c in REQUIRED_COLUMNS if c in df.columns and pd.api.types.is_numeric_dtype(df[c])]
-    if not feature_cols:
-        logging.error("No valid feature columns found from required columns.")
-        return {"status": "error", "message": "No feature columns available for prediction"}
-
     # -------------------------- Prepare features for XGBoost --------------------------
-    X = df[feature_cols]
+    if features is not None:
+        if features.ndim != 2 or features.shape[1] != len(feature_cols):
+            logging.error(f"Feature matrix shape {features.shape} does not match {len(feature_cols)} model features")
+            return {"status": "error", "message": "No feature columns available for prediction"}
+        # Object arrays (mixed None/number/str) are coerced the same way as the DataFrame path
+        if features.dtype == object:
+            features = pd.DataFrame(features).apply(pd.to_numeric, errors="coerce").to_numpy()
+        arr = np.ascontiguousarray(features, dtype=np.float32)
+    else:
+        # A bare ndarray carries no column names, so every model feature must be present;
+        # columns are then selected in the model's training order
+        missing_cols = [c for c in feature_cols if c not in df.columns]
+        if missing_cols:
+            logging.error(f"Missing feature columns: {missing_cols}")
+            return {"status": "error", "message": "No feature columns available for prediction"}
+
+        # Object columns (mixed None/number from Mongo) are coerced in one pass;
+        # unparseable values become NaN, which XGBoost treats as missing
+        X = df[feature_cols].apply(pd.to_numeric, errors="coerce")
+        arr = np.ascontiguousarray(X.to_numpy(dtype=np.float32))
 
     # -------------------------- Run prediction --------------------------
     try:
-        dmatrix = xgb.DMatrix(X)
-        preds = model.predict(dmatrix)  # probability/confidence
-        df["confidence_score"] = preds
-        df["prediction"] = "BUY"  # default action
+        preds = _predict(model, arr)  # probability/confidence
         logging.info("Predictions and confidence scores generated for all symbols")
     except Exception as e:
         logging.error(f"Error during prediction: {e}")
         return {"status": "error", "message": "Prediction failed"}
 
     # -------------------------- Prepare output --------------------------
-    # Orchestrator will add symbol, so we only keep prediction & confidence_score here
-    columns_to_return = ["prediction", "confidence_score"]
-    df_to_return = df[columns_to_return]
+    # Orchestrator will add symbol, so we only return prediction & confidence_score here.
+    # Built fresh from the predictions so the input frame is left untouched.
+    df_to_return = pd.DataFrame({
+        "prediction": np.full(len(preds), "BUY", dtype=object),  # default action
+        "confidence_score": preds,
+    })
 
     return {"status": "success", "suggested_trades": df_to_return}
@@ -4,22 +4,158 @@
 import os
 import json
 import logging
+import numpy as np
 import pandas as pd
-from pymongo import MongoClient
+from bson.decimal128 import Decimal128
+from pymongo import MongoClient, UpdateOne
 from buy_model import run as model_run  # your existing model logic function
+from buy_model import get_feature_columns
 from dotenv import load_dotenv
 
 logging.basicConfig(level=logging.INFO)
 
-# Define the columns to pass to the buy model (bought columns)
-BOUGHT_COLUMNS = [
-    "open", "high", "low", "close", "volume",
-    "macd",
-    "macd_signal", "macd_histogram", "rsi", "rsi_sma", "ema_100",
-    "ema_200", "atr", "relative_volume", "quote_volume_ratio",
-    "buy_sell_pressure", "ema_ratio", "rsi_x_relative_volume",
-    "macd_histogram_x_atr", "buy_sell_pressure_x_ema_ratio", "rsi_x_relative_volume", "relative_volume"
-]
+# Max upserts sent per bulk_write call
+BULK_WRITE_BATCH_SIZE = 1000
+
+# MongoClients reused across orchestrator runs, keyed by connection string
+_CLIENT_CACHE = {}
+
+# (connection_str, db_name, collection) triples whose indexes have been created
+_INDEX_ENSURED = set()
+
+# Latest source document each symbol was predicted from, per run configuration:
+# {(connection_str, db, collection, suggested_collection, model_file, mtime): {symbol: (timestamp, _id)}}
+_LAST_SEEN = {}
+
+
+def _get_client(connection_str):
+    """
+    Return a shared MongoClient for connection_str, creating it on first use so
+    repeated runs skip the connection handshake and topology discovery.
+    """
+    client = _CLIENT_CACHE.get(connection_str)
+    if client is None:
+        client = MongoClient(connection_str, maxPoolSize=64)
+        _CLIENT_CACHE[connection_str] = client
+    return client
+
+
+def close_clients():
+    """Close every cached MongoClient and reset per-process run state (call once on shutdown)."""
+    for client in _CLIENT_CACHE.values():
+        client.close()
+    _CLIENT_CACHE.clear()
+    _INDEX_ENSURED.clear()
+    _LAST_SEEN.clear()
+
+
+def _to_float(value):
+    """Coerce one document value to float; None and unparseable values become NaN."""
+    if isinstance(value, Decimal128):
+        value = value.to_decimal()
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _fetch_features(collection, coins, feature_cols, last_seen):
+    """
+    Fetch the latest feature document per coin in one aggregation and stream the
+    ones that changed since last_seen into a float32 matrix in feature_cols order.
+
+    Returns (X, symbols, ids, versions, found_symbols): rows of X line up with
+    symbols/ids/versions, and found_symbols holds every coin that had any data.
+    Raises ValueError if a feature is absent from every document put in X.
+    """
+    # One aggregation instead of one find() per coin: latest document per symbol,
+    # projected down to the fields the model and the save step actually use
+    projection = {c: 1 for c in feature_cols}
+    projection.update({"symbol": 1, "_id": 1, "timestamp": 1})
+    pipeline = [
+        {"$match": {"symbol": {"$in": coins}}},
+        {"$sort": {"symbol": 1, "timestamp": -1}},
+        {"$project": projection},
+        {"$group": {"_id": "$symbol", "doc": {"$first": "$$ROOT"}}},
+        {"$replaceRoot": {"newRoot": "$doc"}},
+    ]
+
+    # At most one document per coin, so the matrix is preallocated and filled in the
+    # model's column order straight from the cursor (missing/unparseable values become NaN)
+    X = np.empty((len(coins), len(feature_cols)), dtype=np.float32)
+    symbols = []
+    ids = []
+    versions = []
+    found_symbols = set()
+    present = np.zeros(len(feature_cols), dtype=bool)
+    for doc in collection.aggregate(pipeline, allowDiskUse=False):
+        symbol = doc["symbol"]
+        found_symbols.add(symbol)
+        version = (doc.get("timestamp"), doc["_id"])
+        if last_seen.get(symbol) == version:
+            continue
+
+        i = len(symbols)
+        symbols.append(symbol)
+        ids.append(doc["_id"])  # kept as ObjectId: 12 bytes in BSON vs a 24-char hex string
+        versions.append(version)
+        for j, c in enumerate(feature_cols):
+            if c in doc:
+                present[j] = True
+            X[i, j] = _to_float(doc.get(c))
+
+    # A feature no document carries would otherwise predict silently as all-NaN
+    if symbols and not present.all():
+        missing_cols = [c for c, seen in zip(feature_cols, present) if not seen]
+        raise ValueError(f"Missing feature columns: {missing_cols}")
+
+    return X[:len(symbols)], symbols, ids, versions, found_symbols
+
+
+def _run_model(X, model_file):
+    """
+    Run the buy model on feature matrix X. Returns (predictions, confidence)
+    arrays aligned with the rows of X, or None if the model produced nothing usable.
+    """
+    result = model_run({"features": X, "model_file": model_file})
+
+    if result.get("status") != "success":
+        logging.error(f"Model run failed: {result.get('message')}")
+        return None
+
+    suggested_trades = result.get("suggested_trades")
+    if suggested_trades is None or suggested_trades.empty:
+        logging.warning("Model returned no predictions; skipping all coins (no confidence_score).")
+        return None
+
+    if "confidence_score" not in suggested_trades.columns:
+        logging.warning("Model did not return confidence_score. Skipping all coins.")
+        return None
+    confidence = suggested_trades["confidence_score"].to_numpy(dtype=np.float32)
+
+    # -------------------------- Set default prediction if missing --------------------------
+    if "prediction" in suggested_trades.columns:
+        predictions = suggested_trades["prediction"].to_numpy(dtype=object)
+        # np.where builds a new array; to_numpy() can be a read-only view under copy-on-write
+        predictions = np.where(pd.isnull(predictions), "BUY", predictions)
+    else:
+        predictions = np.full(len(confidence), "BUY", dtype=object)
+
+    return predictions, confidence
+
+
+def _upsert(collection, symbols, ids, predictions, confidence):
+    """Upsert aligned symbol/buyid/prediction/confidence rows keyed by symbol + prediction."""
+    ops = [
+        UpdateOne(
+            {"symbol": s, "prediction": p},                                          # filter by symbol + prediction
+            {"$set": {"symbol": s, "buyid": b, "prediction": p, "confidence_score": float(c)}},  # update these fields
+            upsert=True                                                              # insert if not exists
+        )
+        for s, b, p, c in zip(symbols, ids, predictions, confidence)
+    ]
+    for start in range(0, len(ops), BULK_WRITE_BATCH_SIZE):
+        collection.bulk_write(ops[start:start + BULK_WRITE_BATCH_SIZE], ordered=False)
 
 
 def orchestrator_stage2(config):
@@ -62,103 +198,101 @@ def orchestrator_stage2(config):
         logging.error("Invalid coins list in coins_file")
         return
 
+    # -------------------------- Resolve model feature layout --------------------------
+    try:
+        feature_cols = get_feature_columns(model_file)
+    except Exception as e:
+        logging.error(f"Error loading model feature columns: {e}")
+        return
+
     # -------------------------- Connect to MongoDB --------------------------
     try:
-        client = MongoClient(connection_str)
+        client = _get_client(connection_str)
         db = client[db_name]
         collection_name = db[collection_name_str]
         suggested_trades_collection = db[suggested_trades_collection_name]
         logging.info(f"Connected to MongoDB database: {db_name}")
 
+        # Compound index so the latest-per-symbol lookup is an index walk
+        source_key = (connection_str, db_name, collection_name_str)
+        if source_key not in _INDEX_ENSURED:
+            collection_name.create_index([("symbol", 1), ("timestamp", -1)])
+            _INDEX_ENSURED.add(source_key)
+
         # Ensure unique compound index on symbol + prediction (run once)
-        suggested_trades_collection.create_index(
-            [("symbol", 1), ("prediction", 1)],
-            unique=True
-        )
+        suggested_key = (connection_str, db_name, suggested_trades_collection_name)
+        if suggested_key not in _INDEX_ENSURED:
+            suggested_trades_collection.create_index(
+                [("symbol", 1), ("prediction", 1)],
+                unique=True
+            )
+            _INDEX_ENSURED.add(suggested_key)
     except Exception as e:
         logging.error(f"Error connecting to MongoDB: {e}")
         return
 
     # -------------------------- Fetch latest features --------------------------
     logging.info(f"Fetching latest features for {len(coins)} coins from MongoDB")
-    all_latest_rows = []
 
-    for symbol in coins:
-        doc = collection_name.find({"symbol": symbol}).sort("timestamp", -1).limit(1)
-        df_symbol = pd.DataFrame(list(doc))
-        if df_symbol.empty:
-            logging.warning(f"No feature data found for {symbol}")
-            continue
-        all_latest_rows.append(df_symbol)
+    # Symbols whose latest document was already predicted and saved with this
+    # model are skipped; a new model file (or mtime) starts from a clean slate
+    state_key = (connection_str, db_name, collection_name_str, suggested_trades_collection_name,
+                 model_file, os.path.getmtime(model_file))
+    last_seen = _LAST_SEEN.setdefault(state_key, {})
+    for stale_key in [k for k in _LAST_SEEN if k[:5] == state_key[:5] and k != state_key]:
+        del _LAST_SEEN[stale_key]
 
-    if not all_latest_rows:
-        logging.error("No data found for any coin. Exiting.")
-        client.close()
+    try:
+        X, symbols, ids, versions, found_symbols = _fetch_features(
+            collection_name, coins, feature_cols, last_seen
+        )
+    except Exception as e:
+        logging.error(f"Error fetching latest features from MongoDB: {e}")
         return
 
-    # -------------------------- Combine data --------------------------
-    df_latest = pd.concat(all_latest_rows, ignore_index=True)
-    logging.info(f"Fetched latest data for {len(df_latest)} coins")
-
-    # -------------------------- Filter DataFrame for buy model --------------------------
-    df_model_input = df_latest[[c for c in BOUGHT_COLUMNS if c in df_latest.columns]]
+    if not found_symbols:
+        logging.error("No data found for any coin. Exiting.")
+        return
 
-    # -------------------------- Run model predictions --------------------------
-    model_input = {"data": df_model_input, "model_file": model_file}
-    result = model_run(model_input)
+    for symbol in coins:
+        if symbol not in found_symbols:
+            logging.warning(f"No feature data found for {symbol}")
+    logging.info(f"Fetched latest data for {len(found_symbols)} coins ({len(symbols)} updated since last run)")
 
-    if result.get("status") != "success":
-        logging.error(f"Model run failed: {result.get('message')}")
-        client.close()
+    if not symbols:
+        logging.info("No new feature data since last run; nothing to predict.")
         return
 
-    suggested_trades = result.get("suggested_trades")
-    if suggested_trades is None or suggested_trades.empty:
-        logging.warning("Model returned no predictions; skipping all coins (no confidence_score).")
-        client.close()
+    # -------------------------- Run model predictions --------------------------
+    predicted = _run_model(X, model_file)
+    if predicted is None:
         return
-
-    # -------------------------- Add symbol and buyid --------------------------
-    suggested_trades["symbol"] = df_latest["symbol"].values
-    suggested_trades["buyid"] = df_latest["_id"].astype(str).values  # link to source document
-
-    # -------------------------- Set default prediction if missing --------------------------
-    if "prediction" not in suggested_trades.columns:
-        suggested_trades["prediction"] = "BUY"
-    suggested_trades["prediction"].fillna("BUY", inplace=True)
+    predictions, confidence = predicted
 
     # -------------------------- Only keep rows with valid confidence_score --------------------------
-    if "confidence_score" not in suggested_trades.columns:
-        logging.warning("Model did not return confidence_score. Skipping all coins.")
-        client.close()
-        return
-
-    suggested_trades = suggested_trades[suggested_trades["confidence_score"].notnull()]
-
-    if suggested_trades.empty:
+    mask = ~np.isnan(confidence)
+    if not mask.any():
         logging.warning("No predictions with confidence_score available. Exiting.")
-        client.close()
         return
 
-    # -------------------------- Keep only required fields --------------------------
-    columns_to_save = ["symbol", "buyid", "prediction", "confidence_score"]
-    df_to_save = suggested_trades[[c for c in columns_to_save if c in suggested_trades.columns]]
+    # -------------------------- Keep only required fields, add symbol and buyid --------------------------
+    symbols_to_save = np.asarray(symbols, dtype=object)[mask]
+    ids_to_save = np.asarray(ids, dtype=object)[mask]  # link to source document
 
     # -------------------------- Save to MongoDB (update existing, no duplicates) --------------------------
     try:
-        for record in df_to_save.to_dict("records"):
-            suggested_trades_collection.update_one(
-                {"symbol": record["symbol"], "prediction": record["prediction"]},  # filter by symbol + prediction
-                {"$set": record},                                               # update these fields
-                upsert=True                                                     # insert if not exists
-            )
+        _upsert(suggested_trades_collection, symbols_to_save, ids_to_save, predictions[mask], confidence[mask])
         logging.info(
-            f"Saved {len(df_to_save)} buy predictions (upserted by symbol + prediction) to collection {suggested_trades_collection_name}"
+            f"Saved {len(symbols_to_save)} buy predictions (upserted by symbol + prediction) to collection {suggested_trades_collection_name}"
         )
     except Exception as e:
         logging.error(f"Error saving suggested trades to MongoDB: {e}")
+        return
+
+    # Only remember symbols once their prediction is actually stored
+    for i in np.flatnonzero(mask):
+        last_seen[symbols[i]] = versions[i]
 
-    client.close()
     logging.info("Stage 2 prediction orchestrator completed successfully.")
 
 
@@ -186,3 +320,4 @@ if __name__ == "__main__":
     }
 
     orchestrator_stage2(config)
+    close_clients()